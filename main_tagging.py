@@ -6,6 +6,8 @@ import copy
 # import statprof
 
 import numpy as np
+import tensorflow as tf
+import keras.backend as kb
 from keras.callbacks import EarlyStopping, ReduceLROnPlateau
 
 from neural_LM.UD_preparation.extract_tags_from_UD import read_tags_infile, make_UD_pos_and_tag
@@ -16,7 +18,7 @@ DEFAULT_NONE_PARAMS = ["model_file", "test_files", "outfiles", "train_files",
                        "dev_files", "dump_file", "save_file", "lm_file",
                        "prediction_files", "comparison_files",
                        "gh_outfiles", "gh_comparison_files"]
-DEFAULT_PARAMS = {}
+DEFAULT_PARAMS = {"use_xla": False, "use_tagger_cache": False}
 DEFAULT_DICT_PARAMS = ["model_params", "read_params", "predict_params", "vocabulary_files",
                        "train_read_params", "dev_read_params", "test_read_params"]
 
@@ -37,6 +39,16 @@ def read_config(infile):
     return params
 
 
+def enable_xla_compilation():
+    """
+    Makes Keras use a session with XLA JIT compilation of the model graphs.
+    Only GPU operations are compiled unless TF_XLA_FLAGS=--tf_xla_cpu_global_jit is set
+    """
+    config = tf.ConfigProto()
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    kb.set_session(tf.Session(config=config))
+
+
 def make_file_params_list(param, k, name="params"):
     if isinstance(param, str):
         param = [param]
@@ -107,12 +119,15 @@ def output_results(outfile, data, pred_labels, corr_labels,
 def make_output(cls, test_data, test_labels, predictions, probs, basic_probs=None,
                 lm=None, outfile=None, comparison_file=None, gold_history=False):
     return_basic_probs = (basic_probs is not None)
-    corr, total, corr_sent = 0, 0, 0
-    for pred, test in zip(predictions, test_labels):
-        total += len(test)
-        curr_corr = sum(int(x == y) for x, y in zip(pred, test))
-        corr += curr_corr
-        corr_sent += int(len(test) == curr_corr)
+    lengths = np.array([len(test) for test in test_labels], dtype=int)
+    total = int(np.sum(lengths))
+    flat_predictions = np.array([x for pred in predictions for x in pred], dtype=str)
+    flat_test_labels = np.array([x for test in test_labels for x in test], dtype=str)
+    are_correct = (flat_predictions == flat_test_labels)
+    corr = int(np.count_nonzero(are_correct))
+    sent_indexes = np.repeat(np.arange(len(test_labels)), lengths)
+    sent_corr = np.bincount(sent_indexes, weights=are_correct, minlength=len(test_labels))
+    corr_sent = int(np.count_nonzero(sent_corr == lengths))
     print("Точность {:.2f}: {} из {} меток".format(100 * corr / total, corr, total))
     print("Точность по предложениям {:.2f}: {} из {} предложений".format(
         100 * corr_sent / len(test_labels), corr_sent, len(test_labels)))
@@ -163,6 +178,8 @@ if __name__ == '__main__':
     if len(sys.argv[1:]) != 1:
         sys.exit("Usage: main.py <config json file>")
     params = read_config(sys.argv[1])
+    if params["use_xla"]:
+        enable_xla_compilation()
     callbacks = []
     word_dictionary = None
     if "stop_callback" in params:
@@ -197,7 +214,7 @@ if __name__ == '__main__':
                   model_file=params["model_file"], save_file=params["save_file"],
                   lm_file=params["lm_file"], **params["vocabulary_files"])
     elif params["load_file"] is not None:
-        cls, train_data = load_tagger(params["load_file"]), None
+        cls, train_data = load_tagger(params["load_file"], use_cache=params["use_tagger_cache"]), None
     else:
         raise ValueError("Either train_file or load_file should be given")
     if params["save_file"] is not None and params["dump_file"] is not None:
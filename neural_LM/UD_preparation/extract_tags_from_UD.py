@@ -1,5 +1,6 @@
 import sys
 from collections import defaultdict
+from functools import lru_cache
 
 
 WORD_COLUMN, POS_COLUMN, TAG_COLUMN = 1, 3, 5
@@ -42,6 +43,8 @@ def decode_word(word):
     return answer
 
 
+# words repeat heavily in corpora, so their processing results are reused
+@lru_cache(maxsize=65536)
 def process_word(word, to_lower=False, append_case=None):
     if all(x.isupper() for x in word) and len(word) > 1:
         uppercase = "<ALL_UPPER>"
@@ -1,17 +1,27 @@
 import sys
+import re
+from functools import lru_cache
+
+import numpy as np
+
+FEAT_PATTERN = re.compile(r"([^|=,]+)=([^|]+)")
+SUBSUMPTION_VALUE_MAPPING = {"Ptan": "Plur", "Brev": "Short"}
+SENTENCE_SEPARATOR = re.compile(r"\n[^\S\n]*\n")
+
+
+@lru_cache(maxsize=65536)
+def _descr_to_fields(symbol):
+    """
+    Splits a tag into its main part and a tuple of feature-value pairs
+    """
+    symbol, _, feats = symbol.partition(",")
+    fields = tuple((key, value) for key, values in FEAT_PATTERN.findall(feats)
+                   for value in values.split(","))
+    return symbol, fields
+
 
 def descr_to_feats(symbol, return_dict=False):
-    if "," in symbol:
-        symbol, feats = symbol.split(",", maxsplit=1)
-        fields = []
-        for elem in feats.split("|"):
-            key, values = elem.split("=", maxsplit=1)
-            values = values.split(",")
-            fields.extend((key, value) for value in values)
-            # fields.append((key, values))
-        fields = tuple(fields)
-    else:
-        fields = ()
+    symbol, fields = _descr_to_fields(symbol)
     if return_dict:
         fields = dict(fields)
     return symbol, fields
@@ -29,28 +39,72 @@ def is_subsumed(first_tag, second_tag):
     for key, value in first_descr.items():
         if key == "Abbr":
             continue
-        if value == "Ptan":
-            value = "Plur"
-        if value == "Brev":
-            value = "Short"
+        value = SUBSUMPTION_VALUE_MAPPING.get(value, value)
         if second_descr.get(key) != value:
             return False
     return True
 
 
+def _subsumption_feats(tag, is_first=False):
+    pos, descr = descr_to_feats(tag, return_dict=True)
+    if is_first:
+        descr = {key: SUBSUMPTION_VALUE_MAPPING.get(value, value)
+                 for key, value in descr.items() if key != "Abbr"}
+    return pos, list(descr.items())
+
+
+def encode_subsuming_tags(tags):
+    """
+    Encodes the tags to be passed as the second argument of make_subsumption_matrix,
+    so that the encoding can be reused for several calls
+    """
+    tags = [_subsumption_feats(tag) for tag in tags]
+    pos_codes, feat_codes = dict(), dict()
+    for pos, feats in tags:
+        pos_codes.setdefault(pos, len(pos_codes))
+        for feat in feats:
+            feat_codes.setdefault(feat, len(feat_codes))
+    pos_array = np.array([pos_codes[pos] for pos, _ in tags], dtype=np.int32)
+    # float32 matrices make np.dot use BLAS, the counts are exact below 2^24
+    absent_feats = np.ones(shape=(len(tags), len(feat_codes)), dtype=np.float32)
+    for i, (_, feats) in enumerate(tags):
+        absent_feats[i, [feat_codes[feat] for feat in feats]] = 0.0
+    return pos_codes, feat_codes, pos_array, absent_feats
+
+
+def make_subsumption_matrix(first_tags, second_tags=None, encoded_second_tags=None):
+    """
+    Returns a boolean matrix whose (i, j)-th element
+    equals is_subsumed(first_tags[i], second_tags[j]),
+    encoded_second_tags is the output of encode_subsuming_tags(second_tags)
+    """
+    if encoded_second_tags is None:
+        encoded_second_tags = encode_subsuming_tags(second_tags)
+    pos_codes, feat_codes, second_pos, absent_feats = encoded_second_tags
+    first = [_subsumption_feats(tag, is_first=True) for tag in first_tags]
+    # tags with unknown POS or features cannot be subsumed by any second tag
+    first_pos = np.array([pos_codes.get(pos, -1) for pos, _ in first], dtype=np.int32)
+    has_unknown_feats = np.zeros(shape=(len(first),), dtype=bool)
+    first_feats = np.zeros(shape=(len(first), len(feat_codes)), dtype=np.float32)
+    for i, (_, feats) in enumerate(first):
+        codes = [feat_codes.get(feat) for feat in feats]
+        has_unknown_feats[i] = (None in codes)
+        first_feats[i, [code for code in codes if code is not None]] = 1.0
+    # the product counts the features of the first tag missing in the second
+    missing_counts = np.dot(first_feats, absent_feats.T)
+    answer = (missing_counts == 0) & (first_pos[:,None] == second_pos[None,:])
+    answer &= ~has_unknown_feats[:,None]
+    return answer
+
+
 def read_tags_input(infile):
-    answer, curr_sent = [], []
     with open(infile, "r", encoding="utf8") as fin:
-        for line in fin:
-            line = line.strip()
-            if line == "":
-                if len(curr_sent) > 0:
-                    answer.append([curr_sent])
-                curr_sent = []
-                continue
-            curr_sent.append(line)
+        text = fin.read()
+    answer = []
+    # sentences are separated by lines containing only whitespace
+    for block in SENTENCE_SEPARATOR.split(text):
+        curr_sent = [line.strip() for line in block.split("\n")]
+        curr_sent = [line for line in curr_sent if line != ""]
         if len(curr_sent) > 0:
             answer.append([curr_sent])
     return answer
-
-
@@ -310,26 +310,33 @@ def add_position_bias(x, bias):
     return kb.bias_add(x, bias, data_format="channels_last")
 
 
+def _split_heads(x, heads, head_dim):
+    """
+    Transforms x of shape (B, T, heads * head_dim) to (B * heads, T, head_dim)
+    """
+    x = kb.reshape(x, (-1, kb.shape(x)[1], heads, head_dim))
+    x = kb.permute_dimensions(x, (0, 2, 1, 3))
+    return kb.reshape(x, (-1, kb.shape(x)[2], head_dim))
+
+
 def self_attention(queries, keys, values, W_query, W_key, W_value,
                    key_bias, value_bias, input_dim, head_dim,
                    attend_future=True):
     queries = kb.dot(queries, W_query)
     keys = kb.dot(keys, W_key)
     values = kb.dot(values, W_value)
-    # separating by heads
-    to_concatenate, probs = [], []
-    for start in range(0, input_dim, head_dim):
-        curr, curr_probs = scaled_attention_with_bias(
-            queries[:, :, start:start+head_dim], keys[:, :, start:start+head_dim],
-            values[:, :, start:start+head_dim], K_bias=key_bias, V_bias=value_bias,
-            scale=kb.sqrt(kb.constant(head_dim)), attend_future=attend_future)
-        to_concatenate.append(curr)
-        probs.append(curr_probs)
-    if len(to_concatenate) > 1:
-        answer = kb.concatenate(to_concatenate, axis=-1)
-        probs = kb.concatenate([kb.expand_dims(x, 0) for x in probs], axis=0)
-    else:
-        answer, probs = to_concatenate[0], kb.expand_dims(probs[0], 0)
+    # all the heads are processed by a single batched contraction
+    heads = input_dim // head_dim
+    answer, probs = scaled_attention_with_bias(
+        _split_heads(queries, heads, head_dim), _split_heads(keys, heads, head_dim),
+        _split_heads(values, heads, head_dim), K_bias=key_bias, V_bias=value_bias,
+        scale=kb.sqrt(kb.constant(head_dim)), attend_future=attend_future)
+    # answer.shape = (B * heads, T, head_dim), probs.shape = (B * heads, T, T')
+    answer = kb.reshape(answer, (-1, heads, kb.shape(answer)[1], head_dim))
+    answer = kb.permute_dimensions(answer, (0, 2, 1, 3))
+    answer = kb.reshape(answer, (-1, kb.shape(answer)[1], input_dim))
+    probs = kb.reshape(probs, (-1, heads, kb.shape(probs)[1], kb.shape(probs)[2]))
+    probs = kb.permute_dimensions(probs, (1, 0, 2, 3))
     return answer, probs
 
 
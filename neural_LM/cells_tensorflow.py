@@ -90,31 +90,26 @@ def fill_by_slices(source, start, slice_length, steps, reverse=False):
     return answer
 
 
-def expand_on_edges(a, L, R):
+def relative_position_indexes(T, k):
     """
-    Expands a by L copies of a[0] on the left and R copies of a[-1] on the right
+    Returns T*T matrix whose (i, j)-th element equals clip(j-i, -k, k) + k
     """
-    left = tf.tile(a[:1], [L] + [1] * (tf.keras.backend.ndim(a) - 1))
-    right = tf.tile(a[-1:], [R] + [1] * (tf.keras.backend.ndim(a) - 1))
-    return tf.concat([left, a, right], axis=0)
+    positions = tf.range(T)
+    offsets = positions[None,:] - positions[:,None]
+    return tf.clip_by_value(offsets, -k, k) + k
 
 
 def batch_add_offset_bias(x, q, bias, transpose_bias=True):
     # performs x_{rij} = x_{rij} + dot(q_{ri}, bias_{clip(j-i, -k, k)}),
     # where clip(a, l, r) = max(l, min(a, r)),
-    B, T = tf.shape(x)[0], tf.shape(x)[1]
+    T = tf.shape(x)[1]
     k = tf.shape(bias)[0] // 2
-    bias = expand_on_edges(bias, T, T)
-    cond = lambda i, ans: i < T
-    def func(x_, q_, b_):
-        b_ = tf.tile(tf.expand_dims(b_, 0), [B, 1, 1])  # b_.shape = (B, T, d)
-        # q_.shape = (B, 1, d)
-        z = tf.matmul(q_, b_, transpose_b=transpose_bias)
-        return x_ + z
-    body = lambda i, ans: (i+1, tf.concat([ans, func(x[:,i:i+1], q[:,i:i+1], bias[T+k-i:2*T+k-i])], axis=1))
-    _, answer = tf.while_loop(cond, body, [0, tf.zeros_like(x[:,:0,:], dtype=x.dtype)],
-                              shape_invariants=[tf.TensorShape([]), tf.TensorShape([None, None, None])])
-    return answer
+    # position_bias.shape = (T, T, d), a single gather replaces the loop over timesteps
+    position_bias = tf.gather(bias, relative_position_indexes(T, k))
+    # timesteps become the batch dimension of matmul
+    q = tf.transpose(q, [1, 0, 2])
+    z = tf.matmul(q, position_bias, transpose_b=transpose_bias)
+    return x + tf.transpose(z, [1, 0, 2])
 
 def generate_future_mask(input_dim):
     ones = tf.ones(shape=(input_dim,), dtype=tf.bool)
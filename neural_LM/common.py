@@ -5,6 +5,8 @@ required by NeuralLM, but possibly useful for other modules
 
 import numpy as np
 import itertools
+from queue import Queue, Full
+from threading import Thread, Event
 
 import keras.backend as kb
 from keras.callbacks import Callback
@@ -19,13 +21,13 @@ AUXILIARY = ['PAD', 'BEGIN', 'END', 'UNKNOWN']
 AUXILIARY_CODES = PAD, BEGIN, END, UNKNOWN = 0, 1, 2, 3
 
 
-def to_one_hot(x, k):
+def to_one_hot(x, k, dtype=np.float32):
     """
     Takes an array of integers and transforms it
-    to an array of one-hot encoded vectors
+    to an array of one-hot encoded vectors.
+    The default dtype is float32 since Keras casts the targets to it anyway
     """
-    unit = np.eye(k, dtype=int)
-    return unit[x]
+    return (np.arange(k) == np.asarray(x)[..., None]).astype(dtype)
 
 
 def repeat_(x, k):
@@ -42,18 +44,14 @@ def batch_transpose(x):
     return kb.permute_dimensions(x, pattern)
 
 
-def mask_future_attention(x, mask_value=-np.inf):
+def mask_future_attention(x, mask_value=-1e9):
     """
-    Masks with mask_value the elements x[..., i, j] with j > i
+    Adds mask_value to the elements x[..., i, j] with j > i,
+    mask_value must be finite since it is multiplied by zero for other elements
     """
-    x_shape = kb.shape(x)
-    mask = generate_future_mask(x_shape[-1])
-    for i in range(kb.ndim(x)-2):
-        mask = kb.expand_dims(mask, 0)
-    tiling_mask = [kb.shape(x)[i] for i in range(kb.ndim(x)-2)] + [1, 1]
-    mask = kb.tile(mask, tiling_mask)
-    mask_tensor = kb.ones_like(x, dtype=x.dtype) * mask_value
-    answer = kb.switch(mask, x, mask_tensor)
+    mask = kb.cast(generate_future_mask(kb.shape(x)[-1]), kb.dtype(x))
+    # the mask is broadcasted over leading dimensions of x instead of being tiled
+    answer = x + (1.0 - mask) * mask_value
     return answer
 
 
@@ -160,7 +158,11 @@ class CustomCallback(Callback):
 def generate_data(X, indexes_by_buckets, output_symbols_number,
                   batch_size=None, use_last=True, has_answer=True,
                   shift_answer=False, shuffle=True, yield_weights=True,
-                  duplicate_answer=False, fields_number=None):
+                  duplicate_answer=False, fields_number=None, trim_padding=False):
+    """
+    trim_padding: whether to cut batch arrays along the timestep axis
+        after the last non-PAD answer, all fields must have timesteps as the second axis
+    """
     if fields_number is None:
         fields_number = len(X[0]) - int(has_answer and not use_last)
     answer_index = 0 if use_last else -1 if has_answer else None
@@ -186,6 +188,12 @@ def generate_data(X, indexes_by_buckets, output_symbols_number,
                         for k in range(fields_number)]
             if has_answer:
                 indexes_to_yield = np.array([X[j][answer_index] for j in bucket_indexes])
+                if trim_padding:
+                    nonpad_columns = np.nonzero(np.any(indexes_to_yield != PAD, axis=0))[0]
+                    if len(nonpad_columns) > 0:
+                        length = nonpad_columns[-1] + 1
+                        to_yield = [elem[:, :length] for elem in to_yield]
+                        indexes_to_yield = indexes_to_yield[:, :length]
                 if shift_answer:
                     padding = np.full(shape=(end - start, 1), fill_value=PAD)
                     indexes_to_yield = np.hstack((indexes_to_yield[:,1:], padding))
@@ -202,6 +210,42 @@ def generate_data(X, indexes_by_buckets, output_symbols_number,
                 yield to_yield
 
 
-
-
-
+def prefetch(iterable, buffer_size=2, timeout=0.1):
+    """
+    Iterates over iterable computing its next elements in a background thread,
+    so that data preparation overlaps with model computations.
+    The thread stops once the consumer finishes or abandons the iteration
+    """
+    queue, end, stop = Queue(maxsize=buffer_size), object(), Event()
+
+    def put(elem):
+        # returns False if the consumer has stopped before elem was queued
+        while not stop.is_set():
+            try:
+                queue.put(elem, timeout=timeout)
+                return True
+            except Full:
+                continue
+        return False
+
+    def fill_queue():
+        try:
+            for elem in iterable:
+                if not put(elem):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(end)
+
+    Thread(target=fill_queue, daemon=True).start()
+    try:
+        while True:
+            elem = queue.get()
+            if elem is end:
+                return
+            if isinstance(elem, Exception):
+                raise elem
+            yield elem
+    finally:
+        stop.set()
@@ -39,7 +39,7 @@ def to_one_hot(indices, num_classes):
     """
     shape = indices.shape
     indices = np.ravel(indices)
-    answer = np.zeros(shape=(indices.shape[0], num_classes), dtype=int)
+    answer = np.zeros(shape=(indices.shape[0], num_classes), dtype=np.float32)
     answer[np.arange(indices.shape[0]), indices] = 1
     return answer.reshape(shape+(num_classes,))
 
@@ -250,8 +250,7 @@ class NeuralLM:
         else:
             answer = np.full(shape=(bucket_length,), fill_value=PAD, dtype=np.int32)
             answer[0], answer[m+1] = BEGIN, END
-            for i, x in enumerate(word, 1):
-                answer[i] = self.vocabulary_.toidx(x)
+            answer[1:m+1] = [self.vocabulary_.toidx(x) for x in word]
         return answer
 
     def _make_feature_vector(self, label, feats):
@@ -99,7 +99,9 @@ class FeatureVocabulary(Vocabulary):
         self.symbol_labels_ = AUXILIARY + labels
         self.symbol_labels_codes_ = {x: i for i, x in enumerate(self.symbol_labels_)}
         # second pass: constructing symbol-feature matrix
-        self.symbol_matrix_ = np.zeros(shape=(len(self.symbols_), len(self.symbol_labels_)))
+        # float32 is the dtype of model inputs, so gathered rows need no further casting
+        self.symbol_matrix_ = np.zeros(shape=(len(self.symbols_), len(self.symbol_labels_)),
+                                       dtype=np.float32)
         for i, symbol in enumerate(self.symbols_):
             if symbol in AUXILIARY:
                 codes = [i]
@@ -113,7 +115,7 @@ class FeatureVocabulary(Vocabulary):
             self.token_codes_ = {token: i for i, token in enumerate(self.tokens_)}
             self.symbol_matrix_ = np.hstack([self.symbol_matrix_,
                                              np.zeros(shape=(self.symbols_number_,
-                                                             len(self.tokens_)), dtype=int)])
+                                                             len(self.tokens_)), dtype=np.float32)])
         else:
             self.tokens_, self.token_codes_ = None, None
         return self
@@ -121,10 +121,8 @@ class WeightedCombinationLayer(kl.Layer):
         embedded_features = kb.bias_add(
             embedded_features, self.features_bias, data_format="channels_last")
         if self.use_dimension_bias:
-            tiling_shape = [1] * (kb.ndim(first)-1) + [kb.shape(first)[-1]]
-            embedded_features = kb.tile(embedded_features, tiling_shape)
-            embedded_features = kb.bias_add(
-                embedded_features, self.dimensions_bias, data_format="channels_last")
+            # broadcasting (M, T, 1) + (input_dim,) instead of tiling embedded_features first
+            embedded_features = embedded_features + self.dimensions_bias
         sigma = kb.sigmoid(embedded_features)
 
         result = weighted_sum(first_, second_, sigma,
@@ -161,9 +159,8 @@ def TemporalDropout(inputs, dropout=0.0):
 def leader_loss(weight):
     def _leader_loss(y_true, y_pred):
         corr_pred = kb.sum(y_true * y_pred, axis=-1)
+        # corr_pred is broadcasted over the last dimension of y_pred
         corr_pred = kb.expand_dims(corr_pred, -1)
-        tiling_shape = [1] * (kb.ndim(y_true) - 1) + [kb.shape(y_pred)[-1]]
-        corr_pred = kb.tile(corr_pred, tiling_shape)
         y_diff = kb.log(y_pred) - kb.log(corr_pred)
         y_diff = kb.maximum(y_diff, 0.0)
         y_diff *= y_diff
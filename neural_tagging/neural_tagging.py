@@ -4,6 +4,8 @@ import inspect
 import json
 import os
 import copy
+import pickle
+import tempfile
 # import statprof
 
 import keras.layers as kl
@@ -12,7 +14,8 @@ import keras.regularizers as kreg
 from keras import Model
 from keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
 
-from neural_LM.UD_preparation.read_tags import is_subsumed, descr_to_feats
+from neural_LM.UD_preparation.read_tags import make_subsumption_matrix,\
+    encode_subsuming_tags, descr_to_feats
 from neural_LM.UD_preparation.extract_tags_from_UD import decode_word
 from neural_LM.vocabulary import Vocabulary, FeatureVocabulary, vocabulary_from_json
 from neural_LM.neural_lm import make_bucket_indexes
@@ -25,13 +28,61 @@ from neural_tagging.dictionary import read_dictionary
 
 BUCKET_SIZE = 32
 MAX_WORD_LENGTH = 30
+MAX_CACHED_WORDS = 10000
+# increase when the structure of tagger data or vocabulary classes changes
+TAGGER_CACHE_VERSION = 1
 
 CASHED_INDEXES = dict()
+# maps id(tag_dictionary) to the dictionary and its encoding by encode_subsuming_tags
+CASHED_ENCODED_DICTIONARIES = dict()
 CALLS = 0
 
-def load_tagger(infile):
+def read_tagger_data(infile, use_cache=False):
+    """
+    Reads tagger description from json file and constructs its vocabularies.
+    If use_cache=True, the result is cached in a pickle file next to infile since
+    parsing and constructing large vocabularies is slow. The cache is ignored
+    if it is older than infile, has another TAGGER_CACHE_VERSION or cannot be read
+    """
+    cache_file = infile + ".pkl"
+    if use_cache and os.path.exists(cache_file) and\
+            os.path.getmtime(cache_file) >= os.path.getmtime(infile):
+        try:
+            with open(cache_file, "rb") as fin:
+                cached = pickle.load(fin)
+            if isinstance(cached, dict) and cached.get("version") == TAGGER_CACHE_VERSION:
+                return cached["data"]
+        except Exception:
+            pass
     with open(infile, "r", encoding="utf8") as fin:
         json_data = json.load(fin)
+    for key, value in json_data.items():
+        if key == "symbols_":
+            json_data[key] = vocabulary_from_json(value)
+        elif key == "tags_":
+            json_data[key] = vocabulary_from_json(value, use_features=True)
+        elif key == "morpho_dict_":
+            use_features = json_data["morpho_dict_params"].get("type") in ["features" "native"]
+            json_data[key] = vocabulary_from_json(value, use_features=use_features)
+    if use_cache:
+        # writing to a temporary file and renaming it prevents
+        # concurrent readers from seeing a partially written cache
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(infile)),
+                                            suffix=".pkl.tmp")
+            with os.fdopen(fd, "wb") as fout:
+                pickle.dump({"version": TAGGER_CACHE_VERSION, "data": json_data},
+                            fout, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except Exception:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return json_data
+
+
+def load_tagger(infile, use_cache=False):
+    json_data = read_tagger_data(infile, use_cache=use_cache)
     args = {key: value for key, value in json_data.items()
             if not (key.endswith("_") or key.endswith("callback") or
                     key in ["dump_file", "lm_file"])}
@@ -53,15 +104,8 @@ def load_tagger(infile):
     # обучаемые параметры
     args = {key: value for key, value in json_data.items() if key[-1] == "_"}
     for key, value in args.items():
-        if key == "symbols_":
-            value = vocabulary_from_json(value)
-        elif key == "tags_":
-            value = vocabulary_from_json(value, use_features=True)
-        elif key == "tag_embeddings_":
+        if key == "tag_embeddings_":
             value = np.asarray(value)
-        elif key == "morpho_dict_":
-            use_features = tagger.morpho_dict_params.get("type") in ["features" "native"]
-            value = vocabulary_from_json(value, use_features=use_features)
         setattr(tagger, key, value)
     # loading language model
     if tagger.use_lm and "lm_file" in json_data:
@@ -69,8 +113,8 @@ def load_tagger(infile):
     # compiling morpho dictionary (if any)
     if tagger.morpho_dict is not None:
         tagger._make_morpho_dict_indexes_func(tagger.morpho_dict_params["type"])
-    # модель
-    tagger.build()  # не работает сохранение модели, приходится сохранять только веса
+    # модель, для предсказания компиляция с оптимизатором не нужна
+    tagger.build(compile_model=False)  # не работает сохранение модели, приходится сохранять только веса
     tagger.model_.load_weights(json_data['dump_file'])
     return tagger
 
@@ -79,17 +123,29 @@ def extract_matching_tags(tag, tag_dictionary):
     """
     Returns a list of dictionary tags for a given word
     """
-    # if not hasattr(extract_matching_tags, "CALLS"):
-    #     extract_matching_tags.CALLS = 0
     if tag not in CASHED_INDEXES:
-        CASHED_INDEXES[tag] = []
-        for i, dict_tag in enumerate(tag_dictionary):
-            if is_subsumed(tag, dict_tag):
-                CASHED_INDEXES[tag].append(i)
-        # extract_matching_tags.CALLS += 1
+        cache_matching_tags([tag], tag_dictionary)
     return CASHED_INDEXES[tag]
 
 
+def cache_matching_tags(tags, tag_dictionary):
+    """
+    Finds dictionary tags for all the tags not cached yet
+    using a single subsumption matrix
+    """
+    tags = [tag for tag in set(tags) if tag not in CASHED_INDEXES]
+    if len(tags) == 0:
+        return
+    cached = CASHED_ENCODED_DICTIONARIES.get(id(tag_dictionary))
+    if cached is None or cached[0] is not tag_dictionary:
+        # the dictionary itself is stored to prevent reuse of its id by another object
+        cached = (tag_dictionary, encode_subsuming_tags(tag_dictionary))
+        CASHED_ENCODED_DICTIONARIES[id(tag_dictionary)] = cached
+    subsumption_matrix = make_subsumption_matrix(tags, encoded_second_tags=cached[1])
+    for tag, row in zip(tags, subsumption_matrix):
+        CASHED_INDEXES[tag] = np.nonzero(row)[0].tolist()
+
+
 def extract_feature_indexes(tag, tag_dictionary):
     if tag not in CASHED_INDEXES:
         symbol, feats = descr_to_feats(tag)
@@ -117,7 +173,7 @@ class CharacterTagger:
                  sa_decoder_layers=1, sa_heads_number=1, use_decoder_future=True,
                  use_layer_normalization=True,
                  word_lstm_layers=1, word_lstm_units=128, lstm_dropout=0.0,
-                 use_rnn_for_weight_state=False, weight_state_rnn_units=64,
+                 use_cudnn_lstm=False, use_rnn_for_weight_state=False, weight_state_rnn_units=64,
                  use_fusion=False, fusion_state_units=256, use_dimension_bias=False,
                  use_intermediate_activation_for_weights=False,
                  intermediate_units_for_weights=64,
@@ -125,7 +181,8 @@ class CharacterTagger:
                  regularizer=None, fusion_regularizer=None,
                  probs_threshold=None, lm_probs_threshold=None,
                  batch_size=16, validation_split=0.2, nepochs=25, n_warmup_epochs=0,
-                 min_prob=0.01, max_diff=2.0, to_weigh_loss=True, callbacks=None, verbose=1):
+                 min_prob=0.01, max_diff=2.0, to_weigh_loss=True, trim_padding=False,
+                 callbacks=None, verbose=1):
         self.reverse = reverse
         self.use_lm_loss = use_lm_loss
         self.use_lm = use_lm
@@ -151,6 +208,7 @@ class CharacterTagger:
         self.word_lstm_layers = word_lstm_layers
         self.word_lstm_units = word_lstm_units
         self.lstm_dropout = lstm_dropout
+        self.use_cudnn_lstm = use_cudnn_lstm
         self.lm_dropout = lm_dropout
         self.sa_dropout = sa_dropout
         self.use_self_attention = use_self_attention
@@ -179,6 +237,7 @@ class CharacterTagger:
         self.min_prob = min_prob
         self.max_diff = max_diff
         self.to_weigh_loss = to_weigh_loss
+        self.trim_padding = trim_padding
         self.callbacks = callbacks
         self.verbose = verbose
         self.initialize()
@@ -244,6 +303,7 @@ class CharacterTagger:
                     attr in ["callbacks", "model_", "_basic_model_",
                              "warmup_model_", "_decoder_", "lm_",
                              "morpho_dict_indexes_func_", "word_tag_mapper_", "morpho_dict_",
+                             "_word_vectors_cache_", "_dictionary_indexes_cache_",
                              "regularizer", "fusion_regularizer"]):
                 info[attr] = val
             elif isinstance(val, Vocabulary):
@@ -307,8 +367,13 @@ class CharacterTagger:
             raise NotImplementedError
         elif isinstance(self.morpho_dict, str) and os.path.exists(self.morpho_dict):
             self.word_tag_mapper_ = read_dictionary(self.morpho_dict)
+            self._dictionary_indexes_cache_ = dict()
         else:
             raise ValueError("Dictionary should be 'pymorphy' or path to a file")
+        morpho_dict_type = (self.morpho_dict_params or dict()).get("type", "subsume")
+        if morpho_dict_type == "subsume" and hasattr(self, "tags_"):
+            dictionary_tags = [tag for tags in self.word_tag_mapper_.values() for tag in tags]
+            cache_matching_tags(dictionary_tags, self.tags_.symbols_)
 
     def _make_morpho_dict_indexes_func(self, morpho_dict_type):
         """
@@ -323,6 +388,7 @@ class CharacterTagger:
         else:
             raise ValueError("Unknown morpho_dict_type: {}".format(morpho_dict_type))
         self.morpho_dict_indexes_func_ = func
+        self._dictionary_indexes_cache_ = dict()
 
     def transform(self, data, labels=None, pad=True, return_indexes=True,
                   buckets_number=None, bucket_size=None, join_buckets=True):
@@ -368,39 +434,72 @@ class CharacterTagger:
                     curr_sent_tags = np.zeros(
                         shape=(bucket_length, self.tags_number_), dtype=np.int32)
                     sent = data[index] if not self.reverse else data[i][::-1]
+                    rows, columns = [], []
                     for j, word in enumerate(sent):
-                        word = decode_word(word)
-                        if word is not None and word in self.word_tag_mapper_:
-                            word_tags = self.word_tag_mapper_[word]
-                            for tag in word_tags:
-                                tag_indexes = self.morpho_dict_indexes_func_(tag)
-                                curr_sent_tags[j][tag_indexes] = 1
+                        word_indexes = self._get_dictionary_indexes(word)
+                        rows.extend([j] * len(word_indexes))
+                        columns.extend(word_indexes)
+                    curr_sent_tags[rows, columns] = 1
                     X[index].insert(insert_pos, curr_sent_tags)
         if return_indexes:
             return X, indexes
         else:
             return X
 
+    def _get_dictionary_indexes(self, word):
+        """
+        Returns the indexes of morpho dictionary tags for the word,
+        they do not depend on context, so they are computed once per word
+        """
+        if not hasattr(self, "_dictionary_indexes_cache_"):
+            self._dictionary_indexes_cache_ = dict()
+        answer = self._dictionary_indexes_cache_.get(word)
+        if answer is not None:
+            return answer
+        answer = []
+        decoded_word = decode_word(word)
+        if decoded_word is not None and decoded_word in self.word_tag_mapper_:
+            for tag in self.word_tag_mapper_[decoded_word]:
+                answer.extend(self.morpho_dict_indexes_func_(tag))
+        if len(self._dictionary_indexes_cache_) < MAX_CACHED_WORDS:
+            self._dictionary_indexes_cache_[word] = answer
+        return answer
+
     def _make_sent_vector(self, sent, bucket_length=None):
         if bucket_length is None:
             bucket_length = len(sent)
         answer = np.zeros(shape=(bucket_length, MAX_WORD_LENGTH+2), dtype=np.int32)
         for i, word in enumerate(sent):
-            answer[i, 0] = BEGIN
-            m = min(len(word), MAX_WORD_LENGTH)
-            for j, x in enumerate(word[-m:]):
-                answer[i, j+1] = self.symbols_.toidx(x)
-            answer[i, m+1] = END
-            answer[i, m+2:] = PAD
+            answer[i] = self._make_word_vector(word)
+        return answer
+
+    def _make_word_vector(self, word):
+        """
+        Returns the symbol codes of the word, caching them since most words repeat
+        """
+        if not hasattr(self, "_word_vectors_cache_"):
+            self._word_vectors_cache_ = dict()
+        answer = self._word_vectors_cache_.get(word)
+        if answer is not None:
+            return answer
+        answer = np.zeros(shape=(MAX_WORD_LENGTH+2,), dtype=np.int32)
+        answer[0] = BEGIN
+        m = min(len(word), MAX_WORD_LENGTH)
+        answer[1:m+1] = [self.symbols_.toidx(x) for x in word[len(word)-m:]]
+        answer[m+1] = END
+        answer[m+2:] = PAD
+        if len(self._word_vectors_cache_) < MAX_CACHED_WORDS:
+            self._word_vectors_cache_[word] = answer
         return answer
 
     def _make_tags_vector(self, tags, bucket_length=None, func=None):
         m = len(tags)
         if bucket_length is None:
             bucket_length = m
+        if func is None:
+            func = self.tags_.toidx
         answer = np.zeros(shape=(bucket_length,), dtype=np.int32)
-        for i, tag in enumerate(tags):
-            answer[i] = self.tags_.toidx(tag) if func is None else func(tag)
+        answer[:m] = [func(tag) for tag in tags]
         return answer
 
     def train(self, data, labels, dev_data=None, dev_labels=None,
@@ -415,6 +514,7 @@ class CharacterTagger:
         :return:
         """
         # vocabularies for symbols and tags
+        self._word_vectors_cache_ = dict()
         if symbol_vocabulary_file is None:
             self.symbols_ = Vocabulary(character=True, min_count=self.min_char_count).train(data)
         else:
@@ -474,11 +574,13 @@ class CharacterTagger:
             train_gen = generate_data(X, train_indexes_by_buckets, self.tags_number_,
                                       self.batch_size, use_last=False,
                                       duplicate_answer=False, fields_number=fields_number,
-                                      yield_weights=self.to_weigh_loss)
+                                      yield_weights=self.to_weigh_loss,
+                                      trim_padding=self.trim_padding)
             dev_gen = generate_data(X_dev, dev_indexes_by_buckets, self.tags_number_,
                                     use_last=False, shuffle=False, duplicate_answer=False,
                                     fields_number=fields_number,
-                                    yield_weights=self.to_weigh_loss)
+                                    yield_weights=self.to_weigh_loss,
+                                    trim_padding=self.trim_padding)
             self.warmup_model_.fit_generator(
                 train_gen, steps_per_epoch=train_steps, epochs=self.n_warmup_epochs,
                 callbacks=self.callbacks, validation_data=dev_gen,
@@ -494,11 +596,13 @@ class CharacterTagger:
         train_gen = generate_data(X, train_indexes_by_buckets, self.tags_number_,
                                   self.batch_size, use_last=False,
                                   duplicate_answer=self.use_lm,
-                                  yield_weights=self.to_weigh_loss)
+                                  yield_weights=self.to_weigh_loss,
+                                  trim_padding=self.trim_padding)
         dev_gen = generate_data(X_dev, dev_indexes_by_buckets, self.tags_number_,
                                 use_last=False, shuffle=False,
                                 duplicate_answer=self.use_lm,
-                                yield_weights=self.to_weigh_loss)
+                                yield_weights=self.to_weigh_loss,
+                                trim_padding=self.trim_padding)
         self.model_.fit_generator(
             train_gen, steps_per_epoch=train_steps,
             epochs=self.nepochs-self.n_warmup_epochs,
@@ -517,9 +621,18 @@ class CharacterTagger:
             self.transform(data, labels=labels, bucket_size=BUCKET_SIZE)
         answer, probs = [None] * len(data), [None] * len(data)
         basic_probs = [None] * len(data)
-        for k, (X_curr, bucket_indexes) in enumerate(zip(X_test[::-1], indexes_by_buckets[::-1])):
-            X_curr = [np.array([X_test[i][j] for i in bucket_indexes])
-                      for j in range(len(X_test[0])-int(labels is not None))]
+        # object array allows to decode the labels of a whole sentence by a single indexing
+        tag_symbols = np.array(self.tags_.symbols_, dtype=object)
+        # probabilities for all sentences are stored in a single contiguous buffer,
+        # so that padded bucket outputs are not kept alive by the slices
+        to_store_probs = return_probs or return_basic_probs
+        offsets = np.cumsum([0] + [len(sent) for sent in data])
+        probs_buffer = None
+        fields_number = len(X_test[0]) - int(labels is not None)
+        bucket_inputs = prefetch([np.array([X_test[i][j] for i in bucket_indexes])
+                                  for j in range(fields_number)]
+                                 for bucket_indexes in indexes_by_buckets[::-1])
+        for k, (X_curr, bucket_indexes) in enumerate(zip(bucket_inputs, indexes_by_buckets[::-1])):
             if self.use_lm and labels is None:
                 if self.verbose > 0 and (k < 3 or k % 10 == 0):
                     print("Bucket {} of {} predicting".format(k+1, len(indexes_by_buckets)))
@@ -537,10 +650,16 @@ class CharacterTagger:
                 bucket_labels = np.argmax(bucket_probs, axis=-1)
             for curr_labels, curr_probs, curr_basic_probs, index in\
                     zip(bucket_labels, bucket_probs, bucket_basic_probs, bucket_indexes):
-                curr_labels = curr_labels[:len(data[index])]
-                curr_labels = [self.tags_.symbols_[label] for label in curr_labels]
-                answer[index], probs[index] = curr_labels, curr_probs[:len(data[index])]
-                basic_probs[index] = curr_basic_probs
+                L, start = len(data[index]), offsets[index]
+                answer[index] = tag_symbols[np.asarray(curr_labels[:L], dtype=int)].tolist()
+                if to_store_probs:
+                    if probs_buffer is None:
+                        curr_probs = np.asarray(curr_probs)
+                        probs_buffer = np.empty(shape=(offsets[-1],) + curr_probs.shape[1:],
+                                                dtype=curr_probs.dtype)
+                    probs_buffer[start:start+L] = curr_probs[:L]
+                    probs[index] = probs_buffer[start:start+L]
+                    basic_probs[index] = curr_basic_probs
         return ((answer, probs, basic_probs) if (return_basic_probs and self.use_lm)
                 else (answer, probs) if return_probs else answer)
 
@@ -549,9 +668,10 @@ class CharacterTagger:
             self._make_word_tag_mapper(data)
         X_test, indexes_by_buckets = self.transform(data, labels, bucket_size=BUCKET_SIZE)
         probs, basic_probs = [None] * len(data), [None] * len(data)
-        for k, (X_curr, bucket_indexes) in enumerate(zip(X_test[::-1], indexes_by_buckets[::-1])):
-            X_curr = [np.array([X_test[i][j] for i in bucket_indexes])
-                      for j in range(len(X_test[0])-1)]
+        bucket_inputs = prefetch([np.array([X_test[i][j] for i in bucket_indexes])
+                                  for j in range(len(X_test[0])-1)]
+                                 for bucket_indexes in indexes_by_buckets[::-1])
+        for k, (X_curr, bucket_indexes) in enumerate(zip(bucket_inputs, indexes_by_buckets[::-1])):
             y_curr = [np.array(X_test[i][-1]) for i in bucket_indexes]
             bucket_probs = self.model_.predict(X_curr, batch_size=256)
             if self.use_lm:
@@ -683,7 +803,7 @@ class CharacterTagger:
             self.tag_embeddings_ /= np.linalg.norm(self.tag_embeddings_, axis=1)[:,None]
         return self
 
-    def build(self):
+    def build(self, compile_model=True):
         word_inputs = kl.Input(shape=(None, MAX_WORD_LENGTH+2), dtype="int32")
         inputs, basic_inputs = [word_inputs], [word_inputs]
         if hasattr(self, "lm_"):
@@ -723,9 +843,8 @@ class CharacterTagger:
                 decoder_inputs = [pre_outputs, states, position_inputs, lm_state_inputs]
             else:
                 if self.use_rnn_for_weight_state:
-                    first_gate_inputs = kl.Bidirectional(kl.LSTM(
-                        self.weight_state_rnn_units, dropout=self.lstm_dropout,
-                        return_sequences=True))(word_outputs)
+                    first_gate_inputs = self._build_bidirectional_lstm(
+                        word_outputs, self.weight_state_rnn_units)
                 else:
                     first_gate_inputs = word_outputs
                 lm_inputs = TemporalDropout(lm_inputs, self.lm_dropout)
@@ -746,9 +865,11 @@ class CharacterTagger:
             outputs = pre_outputs
         if self.n_warmup_epochs > 0 and hasattr(self, "lm_"):
             self.warmup_model_ = Model(basic_inputs, pre_outputs)
-            self.warmup_model_.compile(**pre_compile_args)
+            if compile_model:
+                self.warmup_model_.compile(**pre_compile_args)
         self.model_ = Model(inputs, outputs)
-        self.model_.compile(**compile_args)
+        if compile_model:
+            self.model_.compile(**compile_args)
         if hasattr(self, "lm_"):
             self._basic_model_ = kb.Function(basic_inputs + [kb.learning_phase()], decoder_inputs[:3])
             self._decoder_ = kb.Function(decoder_inputs + [kb.learning_phase()], [final_outputs])
@@ -758,9 +879,11 @@ class CharacterTagger:
 
     def build_word_cnn(self, inputs):
         # inputs = kl.Input(shape=(MAX_WORD_LENGTH,), dtype="int32")
-        inputs = kl.Lambda(kb.one_hot, arguments={"num_classes": self.symbols_number_},
-                           output_shape=lambda x: tuple(x) + (self.symbols_number_,))(inputs)
-        char_embeddings = kl.Dense(self.char_embeddings_size, use_bias=False)(inputs)
+        # embedding lookup is equivalent to one-hot encoding followed by a bias-free Dense layer,
+        # it has the same (symbols_number, char_embeddings_size) weight, so old weights still load;
+        # the initializer matches the Dense default to keep training from scratch unchanged
+        char_embeddings = kl.Embedding(self.symbols_number_, self.char_embeddings_size,
+                                       embeddings_initializer="glorot_uniform")(inputs)
         conv_outputs = []
         self.char_output_dim_ = 0
         for window_size, filters_number in zip(self.char_window_size, self.char_filters):
@@ -800,12 +923,8 @@ class CharacterTagger:
         """
         lstm_outputs = word_outputs
         for j in range(self.word_lstm_layers-1):
-            lstm_outputs = kl.Bidirectional(
-                kl.LSTM(self.word_lstm_units[j], return_sequences=True,
-                        dropout=self.lstm_dropout))(lstm_outputs)
-        lstm_outputs = kl.Bidirectional(
-                kl.LSTM(self.word_lstm_units[-1], return_sequences=True,
-                        dropout=self.lstm_dropout))(lstm_outputs)
+            lstm_outputs = self._build_bidirectional_lstm(lstm_outputs, self.word_lstm_units[j])
+        lstm_outputs = self._build_bidirectional_lstm(lstm_outputs, self.word_lstm_units[-1])
         if hasattr(self, "tag_embeddings_"):
             pre_outputs = self.tag_embeddings_output_layer(lstm_outputs)
         else:
@@ -815,6 +934,20 @@ class CharacterTagger:
                 name="p")(lstm_outputs)
         return pre_outputs, lstm_outputs
 
+    def _build_bidirectional_lstm(self, inputs, units):
+        """
+        Applies a bidirectional LSTM, using the cuDNN kernel when use_cudnn_lstm=True.
+        cuDNN supports no recurrent dropout, so input dropout is applied by a separate layer.
+        The weights of CuDNNLSTM are not compatible with the ones of LSTM
+        """
+        if self.use_cudnn_lstm:
+            if self.lstm_dropout > 0.0:
+                inputs = kl.Dropout(self.lstm_dropout)(inputs)
+            lstm = kl.CuDNNLSTM(units, return_sequences=True)
+        else:
+            lstm = kl.LSTM(units, return_sequences=True, dropout=self.lstm_dropout)
+        return kl.Bidirectional(lstm)(inputs)
+
     def _build_attention_network(self, encoded):
         for i in range(self.sa_encoder_layers):
             sa_encoder = SelfAttentionEncoder(self.char_output_dim_, heads=self.sa_heads_number)